@@ -1,12 +1,14 @@
 from open3dVisualizer import Open3DVisualizer
 from navigatorBase import NavigatorBase
 from plotter import Plotter
+from voxelGrid import VoxelGrid
 import numpy as np
+import math
 import os
 from tqdm import tqdm
 import open3d as o3d
 from datetime import datetime
-import copy
+from scipy.spatial import cKDTree
 import json
 
 class AbsoluteLidarNavigator(NavigatorBase):
@@ -15,6 +17,12 @@ class AbsoluteLidarNavigator(NavigatorBase):
         """Initialize an AbsoluteLidarNavigator by reading metadata and setting
         up a package source from the pcap file.
         """
+
+        # The full cloud is downsampled to this voxel size and cropped to this radius
+        # around the current position before being used as the registration target.
+        self.full_cloud_voxel_size = 0.2
+        self.full_cloud_crop_radius = 50.0
+
         self.load_point_cloud(args.point_cloud)
 
         NavigatorBase.__init__(self, args, 0)
@@ -45,7 +53,7 @@ class AbsoluteLidarNavigator(NavigatorBase):
             self.full_cloud.points = o3d.utility.Vector3dVector(points)
             self.print_cloud_info("Full cloud moved", self.full_cloud, "    ")
             print("    > Estimating normals")
-            self.full_cloud.estimate_normals(search_param=o3d.geometry.KDTreeSearchParamHybrid(radius=0.1, max_nn=30))
+            self.full_cloud = self.estimate_normals(self.full_cloud)
         
             # Hard-coded lines for saving a pre-processed point cloud (that is already moved to origo and has normals) with an accompanying .cloud file.
             o3d.io.write_point_cloud("G:\\2021-10-21 - Kartverket, LIDAR\\validation\\Lillehammer\\Punktsky_211021\\assembled-moved-with-normals.pcd", self.full_cloud, compressed=False)
@@ -56,6 +64,43 @@ class AbsoluteLidarNavigator(NavigatorBase):
 
         print("    > Cloud read")
 
+        # Downsample the cloud once, and build a tree over it so that it can be
+        # cropped cheaply around the current position for each frame.
+        print("    > Downsampling")
+        self.full_cloud_ds = self.full_cloud.voxel_down_sample(voxel_size=self.full_cloud_voxel_size)
+        self.full_cloud_ds_tree = cKDTree(np.asarray(self.full_cloud_ds.points))
+        self.print_cloud_info("Full cloud downsampled", self.full_cloud_ds, "    ")
+
+    def get_registration_target(self):
+        """ Returns the part of the downsampled full cloud within the crop radius of the
+        actual coordinate of the current frame, or the whole downsampled cloud if there
+        are no actual coordinates.
+        """
+
+        if self.actual_coordinates is None:
+            return self.full_cloud_ds
+
+        c = self.actual_coordinates[self.current_frame_index]
+        ix = self.full_cloud_ds_tree.query_ball_point(c, r=self.full_cloud_crop_radius)
+
+        return self.full_cloud_ds.select_by_index(ix)
+
+    def get_initial_transformation(self):
+        """ Returns the initial transformation for the registration of the current frame. The
+        frame is moved to the actual coordinate of the current frame, as that is where the target
+        has been cropped, and rotated like the previous registered frame.
+        """
+
+        if self.previous_transformation is not None:
+            transformation = self.previous_transformation.copy()
+        else:
+            transformation = np.identity(4)
+
+        if self.actual_coordinates is not None:
+            transformation[:3,3] = self.actual_coordinates[self.current_frame_index]
+
+        return transformation
+
     def navigate_through_file(self):
         """ Runs through each frame in the file. For each pair of frames, use NICP
         to align the frames, then merge them and downsample the result. The transformation
@@ -70,11 +115,17 @@ class AbsoluteLidarNavigator(NavigatorBase):
         # Initialize the list of movements as well as the merged frame, and the first 
         # source frame.
         self.movements = []
+        self.actual_coordinates = None
 
         self.movement_path = o3d.geometry.LineSet(
             points = o3d.utility.Vector3dVector([]), lines=o3d.utility.Vector2iVector([])
         )
 
+        # The points of the movement path are collected here, and only copied to the
+        # LineSet when it is actually needed.
+        self.movement_path_points = np.empty((self.frame_limit, 3))
+        self.movement_path_length = 0
+
         if args.sbet is not None:
 
             # Read the coordinates from all frames in the PCAP file(s).
@@ -83,27 +134,27 @@ class AbsoluteLidarNavigator(NavigatorBase):
             # and the actual coordinates of the frames are in UTM, and there is
             # therefore no need to rotate them like it is in the visual odometry
             # based navigator.
-            self.actual_coordinates = self.reader.get_coordinates(False)
+            self.actual_coordinates = self.reader.get_coordinates_array(False)
 
             # Translate all coordinates towards origo with the same offset as
             # the point cloud.
-            for c in self.actual_coordinates:
-                c.translate(self.full_point_cloud_offset)
-                c.translate([0, 0, 40])
-
-            self.current_coordinate = self.actual_coordinates[0].clone()
-            self.initial_coordinate = self.actual_coordinates[0].clone()
+            self.actual_coordinates -= self.full_point_cloud_offset
+            self.actual_coordinates[:, 2] -= 40
 
+            n = len(self.actual_coordinates)
             self.actual_movement_path = o3d.geometry.LineSet(
-                points = o3d.utility.Vector3dVector([[p.x, p.y, p.alt] for p in self.actual_coordinates]), 
-                lines = o3d.utility.Vector2iVector([[i, i+1] for i in range(len(self.actual_coordinates) - 1)])
+                points = o3d.utility.Vector3dVector(self.actual_coordinates), 
+                lines = o3d.utility.Vector2iVector(np.stack([np.arange(n - 1), np.arange(1, n)], axis=1).astype(np.int32))
             )
             self.actual_movement_path.paint_uniform_color([0, 0, 1])
 
         self.vis = None
         self.merged_frame = o3d.geometry.PointCloud()
+        self.merged_grid = VoxelGrid(self.voxel_size) if self.voxel_size > 0 else None
         plot = Plotter(self.preview_always)
 
+        self.start_reading_frames()
+
         # Enumerate all frames until the end of the file and run the merge operation.
         for i in tqdm(range(0, self.frame_limit), total=self.frame_limit, ascii=True, initial=0, **self.tqdm_config):
             
@@ -120,8 +171,9 @@ class AbsoluteLidarNavigator(NavigatorBase):
                             self.vis.refresh_non_blocking()
 
                             # Show the first frame and reset the view
+                            self.ensure_merged_frame_is_downsampled()
                             self.vis.show_frame(self.merged_frame)
-                            self.vis.set_follow_vehicle_view(self.movements[-1])
+                            self.vis.set_follow_vehicle_view()
 
                             self.check_save_screenshot(0, True)
 
@@ -130,7 +182,7 @@ class AbsoluteLidarNavigator(NavigatorBase):
                     # Refresh the non-blocking visualization
                     if self.preview_always:
                         self.vis.refresh_non_blocking()
-                        self.vis.set_follow_vehicle_view(self.movements[-1])
+                        self.vis.set_follow_vehicle_view()
                         self.time("visualization refresh")
 
                         self.check_save_screenshot(i)
@@ -150,6 +202,8 @@ class AbsoluteLidarNavigator(NavigatorBase):
 
                 raise
 
+        self.stop_reading_frames()
+
         # Ensure the final cloud has been downsampled
         self.ensure_merged_frame_is_downsampled()
 
@@ -159,13 +213,13 @@ class AbsoluteLidarNavigator(NavigatorBase):
 
         self.print_cloud_info("Merged frame", self.merged_frame)
         self.print_cloud_info("Full cloud", self.full_cloud)
-        self.draw_registration_result(self.merged_frame, self.full_cloud)
 
+        self.update_movement_path()
         results = self.get_results(plot)
 
         if self.save_path is not None:
             filenameBase = self.save_path.replace("[time]", datetime.now().strftime('%Y-%m-%d_%H-%M-%S_%f%z'))
-            filenameBase = filenameBase.replace("[pcap]", os.path.basename(self.reader.pcap_path).replace(".pcap", ""))
+            filenameBase = filenameBase.replace("[pcap]", os.path.basename(self.current_pcap_path).replace(".pcap", ""))
             self.ensure_dir(filenameBase)
             plot.save_plot(filenameBase + "_plot.png")
             self.save_cloud_as_las(filenameBase + "_cloud.laz", self.merged_frame)
@@ -179,8 +233,10 @@ class AbsoluteLidarNavigator(NavigatorBase):
             plot.print_summary(self.timer)
 
         # Then continue showing the visualization in a blocking way until the user stops it.
+        # The full cloud is shown together with the merged frame in the same visualizer.
         if self.preview_at_end:
             self.vis.show_frame(self.merged_frame)
+            self.vis.add_geometry(self.full_cloud)
             self.vis.remove_geometry(self.movement_path)
             self.vis.add_geometry(self.movement_path)
             self.vis.reset_view()
@@ -191,12 +247,22 @@ class AbsoluteLidarNavigator(NavigatorBase):
 
         return results
 
-    def draw_registration_result(self, source, target):
-        source_temp = copy.deepcopy(source)
-        target_temp = copy.deepcopy(target)
-        source_temp.paint_uniform_color([1, 0.706, 0])
-        target_temp.paint_uniform_color([0, 0.651, 0.929])
-        o3d.visualization.draw_geometries([source_temp, target_temp])
+    def update_movement_path(self):
+        """ Copies the collected movement path points to the movement path LineSet. """
+
+        n = self.movement_path_length
+        self.movement_path.points = o3d.utility.Vector3dVector(self.movement_path_points[:n])
+        self.movement_path.lines = o3d.utility.Vector2iVector(np.stack([np.arange(n - 1), np.arange(1, n)], axis=1).astype(np.int32))
+        self.movement_path.paint_uniform_color([1, 0, 0])
+
+    def ensure_merged_frame_is_downsampled(self):
+
+        if self.merged_grid is None or not self.merged_frame_is_dirty:
+            return
+
+        self.merged_frame = self.merged_grid.to_point_cloud()
+        self.merged_frame_is_dirty = False
+        self.time("cloud downsampling")
 
     def merge_next_frame(self, plot):
         """ Reads the next frame, aligns it with the previous frame, merges them together
@@ -204,15 +270,7 @@ class AbsoluteLidarNavigator(NavigatorBase):
         """
 
         # Fetch the next frame
-        frame = self.reader.next_frame(self.remove_vehicle, self.timer)
-
-        # The following lines are a temporary debugging visualization
-        self.vis = Open3DVisualizer()
-        self.vis.show_frame(self.full_cloud)
-        self.vis.add_geometry(self.actual_movement_path)
-        self.vis.reset_view()
-        self.vis.run()
-        afdsajhuiCRASH
+        frame = self.read_next_frame()
 
         # If it is empty, that (usually) means we have reached the end of
         # the file. Return False to stop the loop.
@@ -221,13 +279,17 @@ class AbsoluteLidarNavigator(NavigatorBase):
 
         # Estimate normals for the target frame (the source frame will always have
         # normals from the previous step).
-        frame.estimate_normals(search_param=o3d.geometry.KDTreeSearchParamHybrid(radius=0.1, max_nn=30))
+        frame = self.estimate_normals(frame)
 
         self.time("normal estimation")
 
+        target = self.get_registration_target()
+
+        self.time("target cropping")
+
         # Run the alignment
-        reg = self.matcher.match(frame, self.full_cloud, 10, None)
-        self.check_save_frame_pair(self.full_cloud, frame, reg)
+        reg = self.matcher.match(frame, target, 10, self.get_initial_transformation())
+        self.check_save_frame_pair(target, frame, reg)
 
         registration_time = self.time("registration")
 
@@ -237,22 +299,23 @@ class AbsoluteLidarNavigator(NavigatorBase):
         plot.timeUsages.append(registration_time)
         plot.rmses.append(reg.inlier_rmse)
         plot.fitnesses.append(reg.fitness)
-        plot.distances.append(np.sqrt(np.dot(movement, movement)))
+        plot.distances.append(math.sqrt(movement[0]*movement[0] + movement[1]*movement[1] + movement[2]*movement[2]))
 
         # Append the newest movement
         self.movements.append(movement)
 
         # Append the new movement to the path
-        self.movement_path.points.append(reg.transformation[:3,3])
-        #self.movement_path = self.movement_path.transform(transformation)
-
-        # Add the new line
-        if len(self.movements) == 2:
-            self.vis.add_geometry(self.movement_path)
-        if len(self.movements) >= 2:
-            self.movement_path.lines.append([len(self.movements) - 2, len(self.movements) - 1])
-            self.movement_path.paint_uniform_color([1, 0, 0])
-            self.vis.update_geometry(self.movement_path)
+        self.movement_path_points[self.movement_path_length] = reg.transformation[:3,3]
+        self.movement_path_length += 1
+
+        # Show the path
+        if self.preview_always:
+            if len(self.movements) == 2:
+                self.update_movement_path()
+                self.vis.add_geometry(self.movement_path)
+            elif len(self.movements) > 2 and len(self.movements) % self.path_update_interval == 0:
+                self.update_movement_path()
+                self.vis.update_geometry(self.movement_path)
 
         self.time("book keeping")
 
@@ -264,32 +327,36 @@ class AbsoluteLidarNavigator(NavigatorBase):
         self.previous_transformation = reg.transformation
 
         # Combine the points from the merged visualization with the points from the next frame
-        transformed_frame = copy.deepcopy(frame)
-        print("")
-        print("")
-        print("Movement", movement)
-        print("Transformation:")
-        print(reg.transformation)
-        self.print_cloud_info("Frame", frame)
-        transformed_frame.transform(reg.transformation)
-        self.print_cloud_info("Transformed frame", transformed_frame)
-        self.merged_frame += transformed_frame
+        transformed_frame = self.transformed_copy(frame, reg.transformation)
+
+        if self.debug:
+            print("")
+            print("")
+            print("Movement", movement)
+            print("Transformation:")
+            print(reg.transformation)
+            self.print_cloud_info("Frame", frame)
+            self.print_cloud_info("Transformed frame", transformed_frame)
+
+        # As the frames are registered in the same (fixed) coordinate system, they can be
+        # added to a voxel grid incrementally instead of downsampling the whole merged cloud
+        # every now and then. The merged cloud is only rebuilt from the grid when needed.
+        if self.merged_grid is not None:
+            self.merged_grid.add(np.asarray(transformed_frame.points), np.asarray(transformed_frame.colors), np.asarray(transformed_frame.normals))
+        else:
+            self.merged_frame += transformed_frame
         self.merged_frame_is_dirty = True
 
         self.time("cloud merging")
 
-        # Downsample the merged visualization to make it faster to work with.
-        # Otherwise it would grow extremely large, as it would contain all points
-        # from all processed point clouds.
-        # Don't do this on every frame, as it takes a lot of time.
-        self.downsample_timer -= 1
-        if self.downsample_timer <= 0:
-            self.ensure_merged_frame_is_downsampled()
-            self.downsample_timer = self.downsample_cloud_after_frames
-
-        # Update the visualization
+        # Update the visualization. Rebuilding the merged cloud from the voxel grid
+        # is expensive for large clouds, so it is only done every now and then.
         if self.preview_always and self.vis is not None:
-            self.vis.show_frame(self.merged_frame, True)
+            self.downsample_timer -= 1
+            if self.merged_grid is None or self.downsample_timer <= 0:
+                self.ensure_merged_frame_is_downsampled()
+                self.downsample_timer = self.downsample_cloud_after_frames
+                self.vis.show_frame(self.merged_frame, True)
 
             self.time("visualization")
 
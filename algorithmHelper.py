@@ -3,6 +3,7 @@ from matchers.downsamplefirst import DownsampleFirstNicpMatcher
 from matchers.globalregistrationfirst import GlobalFirstNicpMatcher
 from matchers.fastglobalregistrationfirst import FastGlobalFirstNicpMatcher
 from matchers.probregmatchers import CpdMatcher, FilterregMatcher
+from matchers.fastgicp import VgicpMatcher
 
 class AlgorithmHelper:
 
@@ -25,6 +26,8 @@ class AlgorithmHelper:
         AlgorithmHelper._add_algorithm(CpdMatcher(tf_type_name="nonrigid"), "CPD nonrigid")
         AlgorithmHelper._add_algorithm(FilterregMatcher(), "Filterreg pt2pt")
         AlgorithmHelper._add_algorithm(FilterregMatcher(objective_type="pt2pl"), "Filterreg pt2pl")
+        AlgorithmHelper._add_algorithm(VgicpMatcher(), "VGICP CUDA")
+        AlgorithmHelper._add_algorithm(VgicpMatcher(use_cuda=False), "VGICP")
 
         return AlgorithmHelper.algorithms
 
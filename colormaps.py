@@ -32,14 +32,27 @@ def normalize(data: np.ndarray, percentile: float = 0.05):
         An array of doubles with the same shape as ``image`` with values
         normalized to the range [0, 1].
     """
-    min_val = np.percentile(data, 100 * percentile)
-    max_val = np.percentile(data, 100 * (1 - percentile))
-    # to protect from division by zero
-    spread = max(max_val - min_val, 1)
+    min_val, spread = normalization_bounds(data, percentile)
     field_res = (data.astype(np.float64) - min_val) / spread
     return field_res.clip(0, 1.0)
 
 
+def normalization_bounds(data: np.ndarray, percentile: float = 0.05):
+    """Find the values used by ``normalize`` to map data to the range [0, 1].
+
+    Args:
+        data: array of data to be transformed for visualization
+        percentile: values in the bottom/top percentile are clambed to 0 and 1
+
+    Returns:
+        The value mapped to 0, and the spread of values mapped to [0, 1].
+    """
+    min_val, max_val = np.percentile(data, [100 * percentile, 100 * (1 - percentile)])
+    # to protect from division by zero
+    spread = max(max_val - min_val, 1)
+    return min_val, spread
+
+
 # generated from:
 # https://daniel.lawrence.lu/public/colortransform/#0_2423_964_352_6_2624_1000_513_11_3248_1000_617_15_415_1000_774
 # const int spezia_n = 256;
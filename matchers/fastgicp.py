@@ -0,0 +1,41 @@
+import numpy as np
+import open3d as o3d
+
+# fast_gicp's Python bindings are built from source, so they are only required
+# when this matcher is actually used.
+try:
+    import pygicp
+except ImportError:
+    pygicp = None
+
+class VgicpMatcher:
+
+    def __init__(self, resolution = 1.0, use_cuda = True):
+        self.resolution = resolution
+        self.use_cuda = use_cuda
+
+    def match(self, source, target, threshold = 1, trans_init = None):
+
+        if pygicp is None:
+            raise ImportError("The VGICP matchers require pygicp (https://github.com/SMRT-AIST/fast_gicp).")
+
+        # Initialize an initial transformation. As lidar frames are roughly
+        # aligned anyway, we use the identity matrix.
+        if trans_init is None:
+            trans_init = np.identity(4)
+
+        # Run voxelized GICP, on the GPU if enabled
+        # pygicp does not expose the maximum number of iterations. The CPU variant takes the
+        # correspondence distance, while the CUDA variant only finds correspondences by voxel.
+        if self.use_cuda:
+            gicp = pygicp.FastVGICPCuda()
+        else:
+            gicp = pygicp.FastVGICP()
+            gicp.set_max_correspondence_distance(threshold)
+        gicp.set_resolution(self.resolution)
+        gicp.set_input_target(np.asarray(target.points))
+        gicp.set_input_source(np.asarray(source.points))
+        transformation = gicp.align(trans_init)
+
+        # Evaluate the result in order to get the same fitness and rmse values as the other matchers
+        return o3d.pipelines.registration.evaluate_registration(source, target, threshold, transformation)
@@ -1,7 +1,7 @@
 from open3dVisualizer import Open3DVisualizer
 from navigatorBase import NavigatorBase
 from plotter import Plotter
-import numpy as np
+import math
 import os
 from tqdm import tqdm
 import open3d as o3d
@@ -31,6 +31,7 @@ class LidarNavigator(NavigatorBase):
         self.movements = []
         self.estimated_coordinates = []
         self.actual_coordinates = []
+        self.compared_coordinates = []
         self.actual_movement_path = None
 
         self.movement_path = o3d.geometry.LineSet(
@@ -44,7 +45,7 @@ class LidarNavigator(NavigatorBase):
             self.initial_coordinate = self.actual_coordinates[0].clone()
 
             self.actual_movement_path = o3d.geometry.LineSet(
-                points = o3d.utility.Vector3dVector([[p.x - self.initial_coordinate.x, p.y - self.initial_coordinate.y, p.alt - self.initial_coordinate.alt] for p in self.actual_coordinates]), 
+                points = o3d.utility.Vector3dVector(self.actual_coordinates.xyz - [self.initial_coordinate.x, self.initial_coordinate.y, self.initial_coordinate.alt]), 
                 lines = o3d.utility.Vector2iVector()
             )
 
@@ -52,11 +53,13 @@ class LidarNavigator(NavigatorBase):
 
         self.merged_frame = self.reader.next_frame(self.remove_vehicle, self.timer)
 
-        self.previous_frame = self.merged_frame
-
         # Estimate normals for the first source frame in order to speed up the 
         # alignment operation.
-        self.previous_frame.estimate_normals(search_param=o3d.geometry.KDTreeSearchParamHybrid(radius=0.1, max_nn=30))
+        self.merged_frame = self.estimate_normals(self.merged_frame)
+
+        self.previous_frame = self.merged_frame
+
+        self.start_reading_frames()
         
         # Initialize the visualizer
         self.vis = Open3DVisualizer()
@@ -105,6 +108,8 @@ class LidarNavigator(NavigatorBase):
 
                 raise
 
+        self.stop_reading_frames()
+
         # Ensure the final cloud has been downsampled
         self.ensure_merged_frame_is_downsampled()
 
@@ -115,7 +120,7 @@ class LidarNavigator(NavigatorBase):
         results = self.get_results(plot)
         
         results["estimated_coordinates"] = [x.json() for x in self.estimated_coordinates]
-        results["actual_coordinates"] = [x.json(True) for x in self.actual_coordinates]
+        results["actual_coordinates"] = [x.json(True) for x in self.actual_coordinates] + [x.json(True) for x in self.compared_coordinates]
 
         if self.save_path is not None:
 
@@ -155,11 +160,11 @@ class LidarNavigator(NavigatorBase):
         plot.timeUsages.append(registration_time)
         plot.rmses.append(reg.inlier_rmse)
         plot.fitnesses.append(reg.fitness)
-        plot.distances.append(np.sqrt(np.dot(movement, movement)))
+        plot.distances.append(math.sqrt(movement[0]*movement[0] + movement[1]*movement[1] + movement[2]*movement[2]))
         
         if self.current_coordinate is not None:
 
-            self.actual_coordinates.append(actual_coordinate)
+            self.compared_coordinates.append(actual_coordinate)
             self.estimated_coordinates.append(self.current_coordinate.clone())
 
             self.current_coordinate.x += movement[0] #TODO: Think this is wrong. Should probably use transformed red line in the end to generate all estimated coordinates.
@@ -173,14 +178,14 @@ class LidarNavigator(NavigatorBase):
             plot.position_error_x.append(dx)
             plot.position_error_y.append(dy)
             plot.position_error_z.append(dz)
-            plot.position_error_2d.append(np.sqrt(dx*dx+dy*dy))
-            plot.position_error_3d.append(np.sqrt(dx*dx+dy*dy+dz*dz))
+            plot.position_error_2d.append(math.sqrt(dx*dx+dy*dy))
+            plot.position_error_3d.append(math.sqrt(dx*dx+dy*dy+dz*dz))
             plot.position_age.append(actual_coordinate.age)
 
     def get_current_position(self):
 
         # Retrieve the index of the currently processed frame
-        ix = self.reader.get_current_frame_index()
+        ix = self.current_frame_index
 
         # Retrieve the SBET data for this frame 
         # This is the original location and time info from the SBET file.
@@ -205,7 +210,7 @@ class LidarNavigator(NavigatorBase):
         """
 
         # Fetch the next frame
-        frame = self.reader.next_frame(self.remove_vehicle, self.timer)
+        frame = self.read_next_frame()
 
         # If it is empty, that (usually) means we have reached the end of
         # the file. Return False to stop the loop.
@@ -214,7 +219,7 @@ class LidarNavigator(NavigatorBase):
 
         # Estimate normals for the target frame (the source frame will always have
         # normals from the previous step).
-        frame.estimate_normals(search_param=o3d.geometry.KDTreeSearchParamHybrid(radius=0.1, max_nn=30))
+        frame = self.estimate_normals(frame)
 
         self.time("normal estimation")
 
@@ -224,9 +229,9 @@ class LidarNavigator(NavigatorBase):
 
         registration_time = self.time("registration")
 
-        # Calculate how much the center point has moved by transforming [0,0,0] with
-        # the calculated transformation
-        movement = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(np.asarray([[0.0,0.0,0.0]]))).transform(reg.transformation).get_center()
+        # Calculate how much the center point has moved. Transforming [0,0,0] with
+        # the calculated transformation gives the translation part of the matrix.
+        movement = reg.transformation[:3,3].copy()
         
         actual_coordinate = self.get_current_position() if self.current_coordinate is not None else None
         self.update_plot(plot, reg, registration_time, movement, actual_coordinate)
@@ -243,7 +248,7 @@ class LidarNavigator(NavigatorBase):
         # Add the new line
         if len(self.movements) == 2:
             self.vis.add_geometry(self.movement_path)
-        if len(self.movements) > 2:
+        elif len(self.movements) > 2 and len(self.movements) % self.path_update_interval == 0:
             self.vis.update_geometry(self.movement_path)
 
         if actual_coordinate is not None:
@@ -258,7 +263,7 @@ class LidarNavigator(NavigatorBase):
             # Add the actual coordinate as a blue line
             if len(self.movements) == 2:
                 self.vis.add_geometry(self.actual_movement_path)
-            elif len(self.movements) > 2:
+            elif len(self.movements) > 2 and len(self.movements) % self.path_update_interval == 0:
                 self.vis.update_geometry(self.actual_movement_path)
 
 
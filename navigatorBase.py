@@ -9,6 +9,22 @@ from taskTimer import TaskTimer
 from algorithmHelper import AlgorithmHelper
 from pcapReaderHelper import PcapReaderHelper
 import argparse
+from numba import njit, prange
+
+@njit(parallel=True, cache=True)
+def min3(xyz):
+    """Returns the minimum of each column of an (N, 3) array, found in a single pass."""
+
+    xmin = np.inf
+    ymin = np.inf
+    zmin = np.inf
+
+    for i in prange(xyz.shape[0]):
+        xmin = min(xmin, xyz[i, 0])
+        ymin = min(ymin, xyz[i, 1])
+        zmin = min(zmin, xyz[i, 2])
+
+    return xmin, ymin, zmin
 
 class NavigatorBase:
 
@@ -34,6 +50,11 @@ class NavigatorBase:
         self.build_cloud_timer = args.build_cloud_after
         self.build_cloud_after = args.build_cloud_after
         self.build_cloud = args.build_cloud_after > 0
+        self.debug = args.debug
+
+        # Uploading the movement paths to the visualizer gets more expensive as they
+        # grow, so they are only refreshed this often (in frames).
+        self.path_update_interval = 10
         
         self.tqdm_config = {}
         self.print_summary_at_end = False
@@ -52,6 +73,29 @@ class NavigatorBase:
             for _ in tqdm(range(0, self.skip_start), ascii=True, desc="Skipping frames", **self.tqdm_config):
                 self.reader.next_frame(False, self.timer)
 
+    def start_reading_frames(self):
+        """ Starts reading the remaining frames in a background thread, so that reading
+        the next frame overlaps with the registration of the current one.
+        """
+        self.current_frame_index = self.reader.get_current_frame_index()
+        self.current_pcap_path = self.reader.pcap_path
+
+        self.frame_reader = self.reader.iter_frames_async(self.remove_vehicle)
+        self.frames = iter(self.frame_reader)
+
+    def read_next_frame(self):
+        """ Returns the next frame read by the background thread (see start_reading_frames),
+        or None if there are no more frames. """
+
+        self.current_frame_index, self.current_pcap_path, frame = next(self.frames, (self.current_frame_index, self.current_pcap_path, None))
+        self.time("frame retrieval")
+
+        return frame
+
+    def stop_reading_frames(self):
+        """ Stops the background thread started by start_reading_frames. """
+        self.frame_reader.stop()
+
     @staticmethod
     def print_cloud_info(title, cloud, prefix = ""):
         mf = np.asarray(cloud.points)
@@ -69,6 +113,38 @@ class NavigatorBase:
         print(prefix + "    > Y: {:.2f} - {:.2f}".format(mins[1], maxs[1]))
         print(prefix + "    > Z: {:.2f} - {:.2f}".format(mins[2], maxs[2]))
 
+    @staticmethod
+    def estimate_normals(cloud):
+        """ Estimates normals for the given cloud using Open3D's tensor API (on the GPU if
+        available) in single precision, which is considerably faster than the legacy KDTreeFlann
+        based estimation. Returns a new legacy point cloud with normals.
+        """
+
+        device = o3d.core.Device("CUDA:0" if o3d.core.cuda.is_available() else "CPU:0")
+        tcloud = o3d.t.geometry.PointCloud.from_legacy(cloud, o3d.core.float32, device)
+        tcloud.estimate_normals(max_nn=30, radius=0.1)
+
+        return tcloud.to_legacy()
+
+    @staticmethod
+    def transformed_copy(cloud, transformation):
+        """ Returns a copy of the given cloud transformed with the given 4x4 transformation
+        matrix. This is done with a single matrix multiplication on the point (and normal)
+        arrays, instead of deep copying the cloud and transforming the copy.
+        """
+
+        R = transformation[:3, :3]
+        t = transformation[:3, 3]
+
+        transformed = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(np.asarray(cloud.points) @ R.T + t))
+
+        if cloud.has_normals():
+            transformed.normals = o3d.utility.Vector3dVector(np.asarray(cloud.normals) @ R.T)
+        if cloud.has_colors():
+            transformed.colors = cloud.colors
+
+        return transformed
+
     def ensure_merged_frame_is_downsampled(self):
 
         if self.voxel_size <= 0:
@@ -104,23 +180,26 @@ class NavigatorBase:
             json.dump(data, f, indent=4)
 
     @staticmethod
-    def save_cloud_as_las(path, cloud):
+    def save_cloud_as_las(path, cloud, chunk_size = 1000000):
+        """ Saves the cloud as a LAS/LAZ file. The points are written in chunks, so that only
+        one chunk needs to be held in the LAS point format at a time. """
 
         xyz = np.asarray(cloud.points)
 
-        las = laspy.create(point_format=3, file_version="1.4")
-        
-        xmin = np.floor(np.min(xyz[:,0]))
-        ymin = np.floor(np.min(xyz[:,1]))
-        zmin = np.floor(np.min(xyz[:,2]))
+        header = laspy.LasHeader(point_format=3, version="1.4")
+        header.offset = np.floor(min3(xyz))
+        header.scale = [0.001, 0.001, 0.001]
+
+        with laspy.open(path, mode="w", header=header) as writer:
+            for start in range(0, len(xyz), chunk_size):
+                chunk = xyz[start:start + chunk_size]
 
-        las.header.offset = [xmin, ymin, zmin]
-        las.header.scale = [0.001, 0.001, 0.001]
-        las.x = xyz[:,0]
-        las.y = xyz[:,1]
-        las.z = xyz[:,2]
+                points = laspy.ScaleAwarePointRecord.zeros(len(chunk), header=header)
+                points.x = chunk[:,0]
+                points.y = chunk[:,1]
+                points.z = chunk[:,2]
 
-        las.write(path)
+                writer.write_points(points)
 
     def check_save_frame_pair(self, source, target, reg):
         """ Saves the frame pair if enabled and fitness is below threshold. """
@@ -131,7 +210,7 @@ class NavigatorBase:
         if reg.fitness >= self.save_frame_pair_threshold:
             return
 
-        filenameBase = os.path.join(self.save_frame_pairs_to, str(reg.fitness) + "_" + os.path.basename(self.reader.pcap_path).replace(".pcap", "") + "_" + datetime.now().strftime('%Y-%m-%d_%H-%M-%S_%f%z'))
+        filenameBase = os.path.join(self.save_frame_pairs_to, str(reg.fitness) + "_" + os.path.basename(self.current_pcap_path).replace(".pcap", "") + "_" + datetime.now().strftime('%Y-%m-%d_%H-%M-%S_%f%z'))
         self.ensure_dir(filenameBase)
         o3d.io.write_point_cloud(filenameBase + "_a.pcd", source, compressed=True)
         o3d.io.write_point_cloud(filenameBase + "_b.pcd", target, compressed=True)
@@ -172,6 +251,7 @@ class NavigatorBase:
         parser.add_argument('--save-screenshots-to', type=str, default=None, required=False, help="If given, point cloud screenshots will be saved in this directory with their indices as filenames (0.png, 1.png, 2.png, etc). Only works if --preview is set to 'always'.")
         parser.add_argument('--save-frame-pairs-to', type=str, default=None, required=False, help="If given, frame pairs with a registered fitness below --save-frame-pair-threshold will be saved to the given directory for manual inspection.")
         parser.add_argument('--save-frame-pair-threshold', type=float, default=0.97, required=False, help="If --save-frame-pairs-to is given, frame pairs with a registered fitness value below this value will be saved.")
+        parser.add_argument('--debug', action='store_true', help="Print debug information (such as the transformation) for every registered frame.")
 
         args = parser.parse_args()
 
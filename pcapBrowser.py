@@ -1,5 +1,6 @@
 from bufferedPcapReader import BufferedPcapReader
 from pcapReaderHelper import PcapReaderHelper
+from pcapReader import filter_points
 from open3dVisualizer import Open3DVisualizer
 import argparse
 import open3d as o3d
@@ -17,15 +18,13 @@ class PcapBrowser:
         self.vis = Open3DVisualizer()
         self.save_screenshots_to = save_screenshots_to
 
-        browser = self
         class RemoveVehicleProcessor:
 
             def process(self, cloud):
                 xyz = np.asarray(cloud.points)
                 colors = np.asarray(cloud.colors)
                 
-                colors = browser.reader.remove_vehicle(xyz, colors)
-                xyz = browser.reader.remove_vehicle(xyz)
+                xyz, colors = filter_points(xyz, colors, True, -1.0)
 
                 cloud = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(xyz))
                 cloud.colors = o3d.utility.Vector3dVector(colors)
@@ -1,15 +1,150 @@
 from ouster import client, pcap
 import open3d as o3d
-from colormaps import colorize, normalize
+from colormaps import normalization_bounds, spezia
 from sbetParser import SbetParser
+from numba import njit, prange
 import numpy as np
 import os
 import json
+import queue
+import threading
 from datetime import datetime
 
+@njit(parallel=True, fastmath=True, cache=True)
+def filter_points(xyz, color, remove_vehicle, max_distance):
+    """Removes unwanted points from a frame in a single pass, and returns the remaining
+    points and their colors as compacted arrays.
+
+    If remove_vehicle is True, points inside the box around the vehicle (which is always
+    stationary at the center) are removed, as we don't want that to interfere with the
+    point cloud alignment. Otherwise, only invalid points (with a zero coordinate) are removed.
+    Points further away than max_distance are also removed, unless max_distance is negative.
+    """
+
+    vw = 0.7
+    vl = 2.2
+    max_d2 = max_distance * max_distance
+    n = xyz.shape[0]
+
+    # First pass: evaluate the combined predicate for each point
+    keep = np.empty(n, dtype=np.bool_)
+    for i in prange(n):
+        x = xyz[i, 0]
+        y = xyz[i, 1]
+        z = xyz[i, 2]
+
+        if remove_vehicle:
+            valid = (x > 0.2) | (x < -vl) | (y > vw) | (y < -vw) | (z > 0.3) | (z < -2)
+        else:
+            valid = (x != 0) & (y != 0) & (z != 0)
+
+        keep[i] = valid & ((max_distance < 0) | (x*x + y*y + z*z <= max_d2))
+
+    # Prefix sum gives the output position of each surviving point
+    positions = np.cumsum(keep)
+    count = positions[-1] if n > 0 else 0
+
+    # Second pass: scatter the surviving points into the compacted arrays
+    xyz_out = np.empty((count, 3), dtype=xyz.dtype)
+    color_out = np.empty((count, 3), dtype=color.dtype)
+    for i in prange(n):
+        if keep[i]:
+            j = positions[i] - 1
+            for k in range(3):
+                xyz_out[j, k] = xyz[i, k]
+                color_out[j, k] = color[i, k]
+
+    return xyz_out, color_out
+
+@njit(parallel=True, fastmath=True, cache=True)
+def apply_xyz_lut(range_field, direction, offset, out):
+    """Computes the cartesian coordinates of each pixel in a (H, W) range field into the given
+    (H * W, 3) array, using precomputed (H * W, 3) direction and offset tables. Pixels without
+    a range are given the coordinate (0, 0, 0), like the Ouster XYZLut does.
+    """
+
+    h, w = range_field.shape
+
+    for row in prange(h):
+        for col in range(w):
+            i = row * w + col
+            r = range_field[row, col]
+
+            for k in range(3):
+                out[i, k] = r * direction[i, k] + offset[i, k] if r != 0 else 0
+
+class AsyncFrameReader:
+
+    def __init__(self, reader, remove_vehicle = False, buffer = 4):
+        """Reads the remaining frames of the given reader in a background thread, which keeps up to
+        buffer frames ready, so that reading the next frame overlaps with processing the current one.
+        Iterating yields (frame index, pcap path, frame). The index and path are read together with
+        the frame, as the reader itself will be ahead of the consumer. Call stop() when done, so that
+        the thread is not left running (and using the Numba kernels) after the last frame is used.
+        """
+
+        self.reader = reader
+        self.remove_vehicle = remove_vehicle
+        self.frames = queue.Queue(maxsize=buffer)
+        self.stopped = threading.Event()
+
+        self.thread = threading.Thread(target=self._produce, daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        # Wait for room in the queue, unless the consumer has stopped reading
+        while not self.stopped.is_set():
+            try:
+                self.frames.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self):
+        try:
+            while not self.stopped.is_set():
+                frame = self.reader.next_frame(self.remove_vehicle)
+                if not self._put((self.reader.get_current_frame_index(), self.reader.pcap_path, frame)) or frame is None:
+                    return
+        except Exception as e:
+            self._put((None, None, e))
+
+    def __iter__(self):
+        while True:
+            ix, pcap_path, frame = self.frames.get()
+            if isinstance(frame, Exception):
+                raise frame
+            if frame is None:
+                return
+            yield ix, pcap_path, frame
+
+    def stop(self):
+        """Stops reading frames, and waits for the background thread to finish."""
+        self.stopped.set()
+        self.thread.join()
+
+@njit(parallel=True, fastmath=True, cache=True)
+def colorize_field(field, min_val, spread, colormap, out):
+    """Normalizes each pixel of a (H, W) field to [0, 1] (see colormaps.normalize) and
+    writes its color from the (256, 3) colormap into the given (H * W, 3) array, in a
+    single pass.
+    """
+
+    h, w = field.shape
+
+    for row in prange(h):
+        for col in range(w):
+            i = row * w + col
+            v = min(max((field[row, col] - min_val) / spread, 0.0), 1.0)
+            c = int(255 * v)
+
+            for k in range(3):
+                out[i, k] = colormap[c, k]
+
 class PcapReader:
 
-    def __init__(self, pcap_path, meta_data_path = None, skip_frames = 0, sbet_path = None):
+    def __init__(self, pcap_path, meta_data_path = None, skip_frames = 0, sbet_path = None, sbet = None):
         """Initialize a LidarVisualizer by reading metadata and setting
         up a package source from the pcap file.
         """
@@ -26,6 +161,20 @@ class PcapReader:
             self.metadata = client.SensorInfo(f.read())
         self.xyzLut = client.XYZLut(self.metadata)
 
+        # The lookup table maps a range r to r * direction + offset for each pixel. Recover
+        # the tables from two constant range images, so that frames can be converted by
+        # apply_xyz_lut into a reused buffer instead of allocating a new array every frame.
+        h = self.metadata.format.pixels_per_column
+        w = self.metadata.format.columns_per_frame
+        xyz_1 = self.xyzLut(np.full((h, w), 1, dtype=np.uint32)).reshape((-1, 3))
+        xyz_2 = self.xyzLut(np.full((h, w), 2, dtype=np.uint32)).reshape((-1, 3))
+        self.xyz_direction = (xyz_2 - xyz_1).astype(np.float32)
+        self.xyz_offset = (2 * xyz_1 - xyz_2).astype(np.float32)
+        self.xyz_buffer = np.empty((h * w, 3), dtype=np.float32)
+
+        self.colormap = spezia.astype(np.float32)
+        self.color_buffer = np.empty((h * w, 3), dtype=np.float32)
+
         self.source = pcap.Pcap(pcap_path, self.metadata)
 
         self.channels = [c for c in client.ChanField.values]
@@ -45,8 +194,13 @@ class PcapReader:
                 self.internal_meta = {}
 
         self.frame_coordinates = None
-        if sbet_path is not None:
-            self.sbet = SbetParser(sbet_path)
+
+        # An already parsed sbet file can be given instead of its path, so that it can be shared between readers
+        if sbet is None and sbet_path is not None:
+            sbet = SbetParser(sbet_path)
+
+        if sbet is not None:
+            self.sbet = sbet
             self.gps_week = self.sbet.get_gps_week(pcap_path = self.pcap_path)
         else:
             self.sbet = None
@@ -57,7 +211,7 @@ class PcapReader:
         if "frame_count" not in self.internal_meta:
             if show_progress:
                 print("Counting frames ...")
-            return len(list(self.enumerate_lidar_packets()))
+            return sum(1 for _ in self.enumerate_lidar_packets())
         return self.internal_meta["frame_count"]
 
     def save_internal_meta(self):
@@ -71,13 +225,15 @@ class PcapReader:
         self.last_read_frame_ix_including_skips = -1
 
     def skip_and_get(self, iterator):
+        # The indices are only counted for frames that were actually read
         try:
             for _ in range(self.skip_frames):
-                self.last_read_frame_ix_including_skips += 1
                 next(iterator)
+                self.last_read_frame_ix_including_skips += 1
+            frame = next(iterator)
             self.last_read_frame_ix += 1
             self.last_read_frame_ix_including_skips += 1
-            return next(iterator)
+            return frame
         except StopIteration:
             return None
 
@@ -185,25 +341,35 @@ class PcapReader:
             self.save_internal_meta()
 
     def get_coordinates(self, rotate=True):
-        """Returns a list of coordinates (SbetRow) corresponding to each LidarPacket in the current Pcap file."""
+        """Returns the coordinates (SbetCoordinates) corresponding to each LidarPacket in the current Pcap file."""
 
         if self.sbet is None:
             return None
 
-        positions = []
-        self.sbet.reset()
+        timestamps = []
         iterator = iter(self.enumerate_lidar_packets())
         for packet in iterator:
-            pos = self.sbet.get_position(self.get_sbet_timestamp(packet), gps_week=self.gps_week, continue_from_previous=True)
-            positions.append(pos)
+            timestamps.append(self.get_sbet_timestamp(packet))
 
             for _ in range(self.skip_frames):
                 next(iterator, None)
 
+        coordinates = self.sbet.get_coordinates(timestamps, self.gps_week)
+
         if not rotate:
-            return positions
+            return coordinates
+
+        return coordinates.rotate(coordinates.heading - np.pi / 2)
+
+    def get_coordinates_array(self, rotate=True):
+        """Returns the coordinates corresponding to each LidarPacket in the current Pcap file as an (N, 3) array of x, y and altitude."""
 
-        return SbetParser.rotate_points(positions, positions[0].heading - np.pi / 2)
+        coordinates = self.get_coordinates(rotate)
+
+        if coordinates is None:
+            return None
+
+        return coordinates.xyz
 
     def get_current_frame_index(self):
         return self.last_read_frame_ix
@@ -218,35 +384,6 @@ class PcapReader:
         # There is a very slight difference, but using the final timestamp seems to give the best position.
         return timestamps[-1]
 
-    def remove_vehicle(self, frame, cloud = None):
-        # Remove the vehicle, which is always stationary at the center. We don't want that
-        # to interfere with the point cloud alignment.
-
-        if cloud is None:
-            cloud = frame
-
-        vw = 0.7
-        vl = 2.2
-        return cloud[((frame[:, 0] > 0.2) | (frame[:, 0] < -vl)) | ((frame[:, 1] > vw) | (frame[:, 1] < -vw)) | ((frame[:, 2] > 0.3) | (frame[:, 2] < -2))]
-
-    def remove_invalid(self, frame, cloud = None):
-        # Remove the vehicle, which is always stationary at the center. We don't want that
-        # to interfere with the point cloud alignment.
-
-        if cloud is None:
-            cloud = frame
-
-        return cloud[(frame[:, 0] != 0) & (frame[:, 1] != 0) & (frame[:, 2] != 0)]
-
-    def remove_outside_distance(self, meters, frame, cloud = None):
-        # Remove the vehicle, which is always stationary at the center. We don't want that
-        # to interfere with the point cloud alignment.
-
-        if cloud is None:
-            cloud = frame
-
-        return cloud[np.sqrt(frame[:,0]**2+frame[:,1]**2+frame[:,2]**2) <= meters]
-
     def next_frame(self, remove_vehicle:bool = False, timer = None):
         """Retrieves the next frame"""
 
@@ -260,33 +397,24 @@ class PcapReader:
             return None
             
         # Prepare the frame for visualization
-        xyz = self.xyzLut(scan)
-        xyz = xyz.reshape((-1, 3))
+        apply_xyz_lut(scan.field(client.ChanField.RANGE), self.xyz_direction, self.xyz_offset, self.xyz_buffer)
+        xyz = self.xyz_buffer
 
         if timer is not None: timer.time("frame reshaping")
 
         key = scan.field(self.channels[1])
 
         # apply colormap to field values
-        key_img = normalize(key)
-        color_img = colorize(key_img)
-        color_img = color_img.reshape((-1, 3))
+        min_val, spread = normalization_bounds(key)
+        colorize_field(key, min_val, spread, self.colormap, self.color_buffer)
+        color_img = self.color_buffer
 
         if timer is not None: timer.time("frame colorization")
 
-        if remove_vehicle:
-            color_img = self.remove_vehicle(xyz, color_img)
-            xyz = self.remove_vehicle(xyz)
-            if timer is not None: timer.time("frame vehicle removal")
-        else:
-            color_img = self.remove_invalid(xyz, color_img)
-            xyz = self.remove_invalid(xyz)
-            if timer is not None: timer.time("frame invalid values removal")
+        max_distance = -1.0 if self.max_distance is None else float(self.max_distance)
+        xyz, color_img = filter_points(xyz, color_img, remove_vehicle, max_distance)
 
-        if self.max_distance is not None:
-            color_img = self.remove_outside_distance(self.max_distance, xyz, color_img)
-            xyz = self.remove_outside_distance(self.max_distance, xyz)
-            if timer is not None: timer.time("frame max distance removal")
+        if timer is not None: timer.time("frame point filtering")
 
         cloud = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(xyz))
         cloud.colors = o3d.utility.Vector3dVector(color_img)
@@ -295,6 +423,10 @@ class PcapReader:
 
         return cloud
 
+    def iter_frames_async(self, remove_vehicle:bool = False, buffer = 4):
+        """Returns an AsyncFrameReader, yielding (frame index, pcap path, frame) for each remaining frame."""
+        return AsyncFrameReader(self, remove_vehicle, buffer)
+
     def read_all_frames(self, remove_vehicle:bool = False):
 
         frames = []
@@ -68,7 +68,8 @@ def read_sbet(sbet_filename, smrmsg_filename) -> np.array:
         ("unknown2", np.float64),
         ("unknown3", np.float64)
     ]
-    sbet_np = np.fromfile(sbet_filename, dtype=np.dtype(sbet_record_types))
-    smrmsg_np = np.fromfile(smrmsg_filename, dtype=np.dtype(smrmsg_record_types))
+    # Memory-mapped (read only), so only the parts that are used are read from disk
+    sbet_np = np.memmap(sbet_filename, dtype=np.dtype(sbet_record_types), mode="r")
+    smrmsg_np = np.memmap(smrmsg_filename, dtype=np.dtype(smrmsg_record_types), mode="r")
 
     return sbet_np, smrmsg_np
\ No newline at end of file
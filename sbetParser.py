@@ -1,42 +1,149 @@
 from sbetHelpers import read_sbet, filename2gpsweek, timestamp_unix2sow, timestamp_sow2unix
 import os
+import copy
 import numpy as np
+from numpy.lib.recfunctions import repack_fields
+import math
 from pyproj import Transformer
+from numba import njit, prange
 from datetime import datetime
 import open3d as o3d
 
-transformer = Transformer.from_crs(4326, 5972)
+# Creating a transformer is expensive (it initializes a PROJ context), so only one
+# instance is created. always_xy makes it take (lon, lat) in the order PROJ expects.
+# The parsers use tm_forward instead, this is kept to check it against.
+transformer = Transformer.from_crs(4326, 5972, always_xy=True)
+
+# The horizontal part of EPSG:5972 is ETRS89 / UTM zone 32N: a transverse mercator
+# projection of the GRS80 ellipsoid.
+TM_A = 6378137.0
+TM_F = 1 / 298.257222101
+TM_LON0 = math.radians(9)
+TM_K0 = 0.9996
+TM_FALSE_EASTING = 500000.0
+TM_FALSE_NORTHING = 0.0
+
+def _kruger_coefficients(a, f):
+    """ Returns the rectifying radius and the 6th order Krüger series coefficients for the given ellipsoid. """
+
+    n = f / (2 - f)
+    n2, n3, n4, n5, n6 = n**2, n**3, n**4, n**5, n**6
+
+    A = a / (1 + n) * (1 + n2 / 4 + n4 / 64 + n6 / 256)
+
+    alpha = np.array([
+        n / 2 - 2 / 3 * n2 + 5 / 16 * n3 + 41 / 180 * n4 - 127 / 288 * n5 + 7891 / 37800 * n6,
+        13 / 48 * n2 - 3 / 5 * n3 + 557 / 1440 * n4 + 281 / 630 * n5 - 1983433 / 1935360 * n6,
+        61 / 240 * n3 - 103 / 140 * n4 + 15061 / 26880 * n5 + 167603 / 181440 * n6,
+        49561 / 161280 * n4 - 179 / 168 * n5 + 6601661 / 7257600 * n6,
+        34729 / 80640 * n5 - 3418889 / 1995840 * n6,
+        212378941 / 319334400 * n6
+    ])
+
+    return A, alpha
+
+TM_RECTIFYING_RADIUS, TM_ALPHA = _kruger_coefficients(TM_A, TM_F)
+TM_E = math.sqrt(TM_F * (2 - TM_F))
+
+@njit(parallel=True, fastmath=True, cache=True)
+def tm_forward(lat, lon):
+    """ Projects the given latitudes and longitudes (in radians) to the x and y coordinates
+    of EPSG:5972, using the Krüger series for the transverse mercator projection. """
+
+    n = len(lat)
+    x = np.empty(n)
+    y = np.empty(n)
+
+    scale = TM_K0 * TM_RECTIFYING_RADIUS
+
+    for i in prange(n):
+        sin_lat = math.sin(lat[i])
+        dlon = lon[i] - TM_LON0
+
+        # Conformal latitude
+        t = math.sinh(math.atanh(sin_lat) - TM_E * math.atanh(TM_E * sin_lat))
+
+        xi_prime = math.atan2(t, math.cos(dlon))
+        eta_prime = math.atanh(math.sin(dlon) / math.sqrt(1 + t * t))
+
+        xi = xi_prime
+        eta = eta_prime
+        for j in range(6):
+            k = 2 * (j + 1)
+            xi += TM_ALPHA[j] * math.sin(k * xi_prime) * math.cosh(k * eta_prime)
+            eta += TM_ALPHA[j] * math.cos(k * xi_prime) * math.sinh(k * eta_prime)
+
+        x[i] = TM_FALSE_EASTING + scale * eta
+        y[i] = TM_FALSE_NORTHING + scale * xi
+
+    return x, y
+
+@njit(cache=True)
+def _find_sow(times, sow, start):
+    """ Returns the index of the first time at or after sow, searching from start, and whether such a time exists. """
+
+    n = len(times)
+
+    # Continuing from the previous position is the common case
+    if start < n and times[start] >= sow:
+        return start, True
+
+    lo = start
+    hi = n
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if times[mid] < sow:
+            lo = mid + 1
+        else:
+            hi = mid
+
+    return lo, lo < n
+
+@njit(cache=True)
+def _rotate_xy(xyz, c, s, ox, oy):
+    """ Rotates the x and y columns of xyz in place around (ox, oy). """
+
+    for i in range(xyz.shape[0]):
+        x = xyz[i, 0] - ox
+        y = xyz[i, 1] - oy
+        xyz[i, 0] = c * x - s * y + ox
+        xyz[i, 1] = s * x + c * y + oy
+
+@njit(cache=True)
+def _min_max(values):
+    """ Returns the smallest and largest of the given values, in one pass. """
+
+    low = values[0]
+    high = values[0]
+    for v in values:
+        if v < low:
+            low = v
+        elif v > high:
+            high = v
+
+    return low, high
+
 class SbetRow:
 
-    def __init__(self, row, sow = 0, index = 0, original = None):
+    __slots__ = ("sow", "lat", "lon", "alt", "age", "index", "x", "y", "heading")
 
-        if original is not None:
-            self.sow = original.sow
-            self.lat = original.lat
-            self.lon = original.lon
-            self.alt = original.alt
-            self.age = original.age
-            self.index = original.index
-            self.x = original.x
-            self.y = original.y
-            self.heading = original.heading
-            return
+    def __init__(self, row, sow = 0, index = 0, x = 0, y = 0):
 
         self.sow = row["time"]
-        self.lat = row["lat"]
-        self.lon = row["lon"]
+        self.lat = math.degrees(row["lat"])
+        self.lon = math.degrees(row["lon"])
         self.alt = row["alt"]
         self.age = sow - row["time"]
         self.heading = row["heading"]
         self.index = index
-
-        self.x, self.y = transformer.transform(self.lat, self.lon)
+        self.x = x
+        self.y = y
 
     def __str__(self, include_lat_lon=True):
         return f'ix={self.index}' + (f', lat={self.lat}, lon={self.lon}, heading={self.heading}' if include_lat_lon else '') + f', alt={self.alt}, x={self.x}, y={self.y}, time={self.sow}, age={self.age}'
 
     def clone(self):
-        return SbetRow(None, None, None, self)
+        return copy.copy(self)
 
     def json(self, actual = False):
         json = {
@@ -55,8 +162,51 @@ class SbetRow:
         self.y -= t[1]
         self.alt -= t[2]
 
-    def np(self):
-        return np.array([self.x, self.y, self.alt])
+class SbetCoordinates:
+
+    def __init__(self, rows, sows, indices, xyz):
+        """ A sequence of coordinates stored as arrays: the sbet rows, the time (seconds of week)
+        each coordinate was requested for, the corresponding row indices, and an (N, 3) array of
+        x, y and altitude. SbetRow objects are only created when single coordinates are accessed.
+        """
+        self.rows = rows
+        self.sows = sows
+        self.indices = indices
+        self.xyz = xyz
+        self.rotated = False
+
+    def __len__(self):
+        return len(self.xyz)
+
+    def __getitem__(self, i):
+        row = SbetRow(self.rows[i], self.sows[i], self.indices[i], self.xyz[i, 0], self.xyz[i, 1])
+        row.alt = self.xyz[i, 2]
+
+        if self.rotated:
+            row.lat = -1
+            row.lon = -1
+
+        return row
+
+    @property
+    def heading(self):
+        """ The heading of the first coordinate. """
+        return self.rows[0]["heading"]
+
+    def rotate(self, heading):
+        """ Rotates all coordinates in place by the given heading around the first coordinate. """
+        _rotate_xy(self.xyz, math.cos(heading), math.sin(heading), self.xyz[0, 0], self.xyz[0, 1])
+        self.rotated = True
+        return self
+
+    @staticmethod
+    def concatenate(coordinates):
+        return SbetCoordinates(
+            np.concatenate([c.rows for c in coordinates]),
+            np.concatenate([c.sows for c in coordinates]),
+            np.concatenate([c.indices for c in coordinates]),
+            np.concatenate([c.xyz for c in coordinates])
+        )
 
 class SbetParser:
 
@@ -64,6 +214,11 @@ class SbetParser:
         self.rows = SbetParser.read_latlon(sbet_filename, sbet_filename.replace(".out", "-smrmsg.out"))
         self.current_index = 0
         self.row_count = len(self.rows)
+        self.times = np.ascontiguousarray(self.rows["time"])
+        self._gps_week_cache = {}
+
+        # Project all coordinates in one call, as projecting each row separately is very slow.
+        self.xs, self.ys = tm_forward(self.rows["lat"], self.rows["lon"])
 
     def reset(self):
         self.current_index = 0
@@ -76,57 +231,76 @@ class SbetParser:
         # Calculate "Seconds of week", which is the time format used in the sbet files
         sow = timestamp_unix2sow(timestamp / 1000000000, gps_week)
 
+        # Find the first row at or after the given time. The rows are sorted by time, so
+        # this is a binary search, unless the search can continue from the previous position.
         start_ix = self.current_index if continue_from_previous else 1
-        for i in range(start_ix, self.row_count):
+        i, found = _find_sow(self.times, sow, start_ix)
 
-            if self.rows[i]["time"] >= sow:
-                self.current_index = i
-                return SbetRow(self.rows[i-1], sow, i)
+        if not found:
+            self.current_index = 0
+            return None
 
-        self.current_index = 0
-        return None
+        self.current_index = i
+        return SbetRow(self.rows[i-1], sow, i, self.xs[i-1], self.ys[i-1])
+
+    def get_coordinates(self, timestamps, gps_week):
+        """ Returns the coordinates (SbetCoordinates) for the given sorted unix timestamps (in
+        nanoseconds), using the same row as get_position would for each of them. """
+
+        sows = timestamp_unix2sow(np.asarray(timestamps) / 1000000000, gps_week)
+        indices = np.maximum(np.searchsorted(self.times, sows), 1)
+
+        if len(indices) > 0 and indices[-1] >= self.row_count:
+            raise ValueError("The timestamps are not within the time span of the sbet file.")
+
+        ix = indices - 1
+        xyz = np.column_stack([self.xs[ix], self.ys[ix], self.rows["alt"][ix]])
+
+        return SbetCoordinates(self.rows[ix], sows, indices, xyz)
+
+    def get_xyz(self):
+        """ Returns the coordinates of all rows as an (N, 3) array of x, y and altitude. """
+        return np.column_stack([self.xs, self.ys, self.rows["alt"]])
 
     def get_gps_week(self, pcap_path = None, pcap_filename = None):
+        key = pcap_path or pcap_filename
+        if key in self._gps_week_cache:
+            return self._gps_week_cache[key]
+
         if pcap_path is not None:
             pcap_filename = os.path.basename(pcap_path)
-        return filename2gpsweek(pcap_filename)
+
+        gps_week = filename2gpsweek(pcap_filename)
+        self._gps_week_cache[key] = gps_week
+
+        return gps_week
 
     @staticmethod
     def read_latlon(sbet_filename, smrmsg_filename):
 
         (sbet, _) = read_sbet(sbet_filename, smrmsg_filename)
-        sbet = sbet[["time", "lat", "lon", "alt", "heading"]]
-        sbet["lat"] = sbet["lat"] * 180 / np.pi
-        sbet["lon"] = sbet["lon"] * 180 / np.pi
-        
-        return sbet
+
+        # Copy the used columns out of the read only memory map. lat and lon are kept in
+        # radians, as that is what the projection needs, and only converted to degrees when shown.
+        return repack_fields(np.asarray(sbet[["time", "lat", "lon", "alt", "heading"]]))
 
     def get_rows(self):
-        return [SbetRow(row) for row in self.rows]
+        return SbetCoordinates(self.rows, np.zeros(self.row_count), np.zeros(self.row_count, dtype=np.int64), self.get_xyz())
     
     def get_rotated_rows(self):
         """ Returns all coordinates rotated so that the initial heading points due north. """
         coords = self.get_rows()
-        return SbetParser.rotate_points(coords, coords[0].heading)
+        return coords.rotate(coords.heading)
 
     @staticmethod
-    def rotate_points(coords, heading):
-        """ Returns all coordinates rotated by the given heading. """
+    def rotate_points(xyz, heading):
+        """ Returns the given (N, 3) array of coordinates rotated by the given heading around the first coordinate. """
 
-        transformed_path = o3d.geometry.LineSet(
-            points = o3d.utility.Vector3dVector([[p.x, p.y, p.alt] for p in coords]), lines = o3d.utility.Vector2iVector([])
-        )
-        R = transformed_path.get_rotation_matrix_from_xyz((0, 0, heading))
-        transformed_path.rotate(R, center=transformed_path.points[0])
-
-        for i in range(len(coords)):
-            c = coords[i]
-            c.lat = -1
-            c.lon = -1
-            c.x = transformed_path.points[i][0]
-            c.y = transformed_path.points[i][1]
-        
-        return coords
+        xyz = np.array(xyz, dtype=np.float64)
+
+        _rotate_xy(xyz, math.cos(heading), math.sin(heading), xyz[0, 0], xyz[0, 1])
+
+        return xyz
 
 if __name__ == "__main__":
 
@@ -139,8 +313,9 @@ if __name__ == "__main__":
     # Create and start a visualization
     parser = SbetParser(args.sbet)
     
-    min_time = np.min(parser.rows["time"])
-    max_time = np.max(parser.rows["time"])
+    # The rows are sorted by time
+    min_time = parser.times[0]
+    max_time = parser.times[-1]
 
     print("Min time:", min_time)
     print("Max time:", max_time)
@@ -157,22 +332,28 @@ if __name__ == "__main__":
         print("Min human time:", datetime.utcfromtimestamp(min_unix_time).strftime("%Y-%m-%d %H:%M:%S"))
         print("Max human time:", datetime.utcfromtimestamp(max_unix_time).strftime("%Y-%m-%d %H:%M:%S"))
 
-    print("Min lat:", np.min(parser.rows["lat"]))
-    print("Max lat:", np.max(parser.rows["lat"]))
+    min_lat, max_lat = _min_max(parser.rows["lat"])
+    print("Min lat:", np.degrees(min_lat))
+    print("Max lat:", np.degrees(max_lat))
     
-    print("Min lon:", np.min(parser.rows["lon"]))
-    print("Max lon:", np.max(parser.rows["lon"]))
+    min_lon, max_lon = _min_max(parser.rows["lon"])
+    print("Min lon:", np.degrees(min_lon))
+    print("Max lon:", np.degrees(max_lon))
 
     print("Initial heading:", parser.rows[0]["heading"])
 
-    coords = parser.get_rows()
+    xs, ys = transformer.transform(parser.rows["lon"], parser.rows["lat"], radians=True)
+    print("Max difference from pyproj:", np.max(np.hypot(parser.xs - xs, parser.ys - ys)))
+
+    xyz = parser.get_xyz()
+    lines = np.stack([np.arange(len(xyz) - 1), np.arange(1, len(xyz))], axis=1).astype(np.int32)
+
     path = o3d.geometry.LineSet(
-        points = o3d.utility.Vector3dVector([[p.x, p.y, p.alt] for p in coords]), lines=o3d.utility.Vector2iVector([[i, i+1] for i in range(len(coords) - 1)])
+        points = o3d.utility.Vector3dVector(xyz), lines=o3d.utility.Vector2iVector(lines)
     )
     
-    coords = parser.get_rotated_rows()
     transformed_path = o3d.geometry.LineSet(
-        points = o3d.utility.Vector3dVector([[p.x, p.y, p.alt] for p in coords]), lines=o3d.utility.Vector2iVector([[i, i+1] for i in range(len(coords) - 1)])
+        points = o3d.utility.Vector3dVector(SbetParser.rotate_points(xyz, parser.rows[0]["heading"])), lines=o3d.utility.Vector2iVector(lines)
     )
     transformed_path.paint_uniform_color([1, 0, 0])
 
@@ -1,18 +1,32 @@
-from pcapReader import PcapReader
+from pcapReader import PcapReader, AsyncFrameReader
 from tqdm import tqdm
-from sbetParser import SbetParser
+from sbetParser import SbetParser, SbetCoordinates
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import numpy as np
 
 class SerialPcapReader:
 
     def __init__(self, pcap_paths, meta_data_paths, skip_frames = 0, sbet_path = None):
-        self.readers = [PcapReader(x[0], x[1], skip_frames, sbet_path=sbet_path) for x in zip(pcap_paths, meta_data_paths)]
+        # Parse the sbet file once and share it between all readers
+        sbet = SbetParser(sbet_path) if sbet_path is not None else None
+
+        self.readers = [PcapReader(x[0], x[1], skip_frames, sbet=sbet) for x in zip(pcap_paths, meta_data_paths)]
         self.current_reader_index = 0
         self.max_distance = None
+        self._frame_offsets = None
         self._set_metadata()
 
     def count_frames(self, show_progress):
-        return sum([x.count_frames(False) for x in tqdm(self.readers, ascii=True, desc="Counting frames", disable=not show_progress)])
+        """Counts the frames of all the pcap files, scanning the files in parallel."""
+
+        if len(self.readers) == 0:
+            return 0
+
+        with ThreadPoolExecutor(max_workers=min(8, len(self.readers))) as executor:
+            futures = [executor.submit(reader.count_frames, False) for reader in self.readers]
+            completed = tqdm(as_completed(futures), total=len(futures), ascii=True, desc="Counting frames", disable=not show_progress)
+
+            return sum(future.result() for future in completed)
 
     def reset(self):
         for reader in self.readers:
@@ -29,59 +43,67 @@ class SerialPcapReader:
 
     def skip_and_get(self, iterator):
 
-        if self.current_reader_index >= len(self.readers):
-            return None
+        while self.current_reader_index < len(self.readers):
+            reader = self.readers[self.current_reader_index]
+            reader.max_distance = self.max_distance
+
+            frame = reader.skip_and_get(iterator)
+            if frame is not None:
+                return frame
 
-        self.readers[self.current_reader_index].max_distance = self.max_distance
-        frame = self.readers[self.current_reader_index].skip_and_get(iterator)
-        if frame is None:
             self._next_reader()
-            return self.skip_and_get(iterator)
 
-        return frame
+        return None
 
     def get_coordinates(self, rotate=True):
-        """Returns a list of coordinates (SbetRow) corresponding to each LidarPacket in the current Pcap file."""
+        """Returns the coordinates (SbetCoordinates) corresponding to each LidarPacket in all the Pcap files."""
 
-        coordinates = []
-        self.readers_first_coordinate_index = []
-        
-        for reader in self.readers:
-            self.readers_first_coordinate_index.append(len(coordinates))
-            coordinates.extend(reader.get_coordinates(False))
-        
-        return SbetParser.rotate_points(coordinates, coordinates[0].heading - np.pi / 2) if rotate else coordinates
+        coordinates = [reader.get_coordinates(False) for reader in self.readers]
+
+        # The index of the first coordinate of each reader, used by get_current_frame_index
+        self._frame_offsets = np.cumsum([0] + [len(c) for c in coordinates[:-1]]).tolist()
+
+        coordinates = SbetCoordinates.concatenate(coordinates)
+
+        return coordinates.rotate(coordinates.heading - np.pi / 2) if rotate else coordinates
+
+    def get_coordinates_array(self, rotate=True):
+        """Returns the coordinates corresponding to each LidarPacket in all the Pcap files as an (N, 3) array of x, y and altitude."""
+
+        return self.get_coordinates(rotate).xyz
 
     def get_current_frame_index(self):
-        ix = 0
 
-        for i, reader in enumerate(self.readers):
-            if reader == self.readers[self.current_reader_index]:
-                ix += reader.get_current_frame_index()
-                break
-            else:
-                ix += self.readers_first_coordinate_index[i]
+        i = min(self.current_reader_index, len(self.readers) - 1)
+
+        # When the coordinates have been read, the index points into them
+        if self._frame_offsets is not None:
+            return self._frame_offsets[i] + self.readers[i].get_current_frame_index()
 
-        return ix
+        # Otherwise, it is the number of frames read before the current one
+        return sum(r.get_current_frame_index() + 1 for r in self.readers[:i]) + self.readers[i].get_current_frame_index()
 
     def print_info(self, frame_index = None, printFunc = print):
         for reader in self.readers:
             reader.print_info(frame_index, printFunc)
 
-    def remove_vehicle(self, frame, cloud = None):
-        return self.readers[0].remove_vehicle(frame, cloud)
-
     def next_frame(self, remove_vehicle:bool = False, timer = None):
-        if self.current_reader_index >= len(self.readers):
-            return None
 
-        self.readers[self.current_reader_index].max_distance = self.max_distance
-        frame = self.readers[self.current_reader_index].next_frame(remove_vehicle, timer)
-        if frame is None:
+        while self.current_reader_index < len(self.readers):
+            reader = self.readers[self.current_reader_index]
+            reader.max_distance = self.max_distance
+
+            frame = reader.next_frame(remove_vehicle, timer)
+            if frame is not None:
+                return frame
+
             self._next_reader()
-            return self.next_frame(remove_vehicle, timer)
 
-        return frame
+        return None
+
+    def iter_frames_async(self, remove_vehicle:bool = False, buffer = 4):
+        """Returns an AsyncFrameReader, yielding (frame index, pcap path, frame) for each remaining frame."""
+        return AsyncFrameReader(self, remove_vehicle, buffer)
 
     def read_all_frames(self, remove_vehicle:bool = False):
 
@@ -90,4 +112,4 @@ class SerialPcapReader:
             frame = self.next_frame(remove_vehicle)
             if frame is None:
                 return frames
-            frames.append(frame)
\ No newline at end of file
+            frames.append(frame)
@@ -0,0 +1,104 @@
+import numpy as np
+import open3d as o3d
+from numba import njit, types
+from numba.typed import Dict
+
+# Each voxel index is packed into 21 bits of a single int64 key, with this offset added
+# to make it positive. This covers +/- 2^20 voxels from origo in each direction.
+VOXEL_KEY_OFFSET = 1 << 20
+
+@njit(cache=True)
+def _add_new_voxels(voxel_index, points, voxel_size, count):
+    """ Registers the voxels of the given points that are not already in voxel_index, with
+    consecutive positions starting at count, and returns the indices of the points that
+    occupy those voxels. Only the first point within each voxel is kept. """
+
+    new = np.empty(len(points), dtype=np.int64)
+    n = 0
+
+    for i in range(len(points)):
+        x = np.int64(np.floor(points[i, 0] / voxel_size)) + VOXEL_KEY_OFFSET
+        y = np.int64(np.floor(points[i, 1] / voxel_size)) + VOXEL_KEY_OFFSET
+        z = np.int64(np.floor(points[i, 2] / voxel_size)) + VOXEL_KEY_OFFSET
+        key = (x << 42) | (y << 21) | z
+
+        if key not in voxel_index:
+            voxel_index[key] = count + n
+            new[n] = i
+            n += 1
+
+    return new[:n]
+
+class VoxelGrid:
+
+    def __init__(self, voxel_size, initial_capacity = 100000):
+        """Initialize an empty VoxelGrid, which keeps one representative point for
+        each voxel of the given size. Adding points only touches the new points, so
+        the accumulated cloud never has to be downsampled again. Unlike voxel_down_sample,
+        the first point added to a voxel is kept as it is, instead of averaging the points.
+        """
+
+        self.voxel_size = voxel_size
+
+        # Maps a packed voxel key to the position of its point in the buffers
+        self.voxel_index = Dict.empty(key_type=types.int64, value_type=types.int64)
+
+        self.points = np.empty((initial_capacity, 3), dtype=np.float32)
+        self.colors = np.empty((initial_capacity, 3), dtype=np.float32)
+        self.normals = np.empty((initial_capacity, 3), dtype=np.float32)
+        self.has_normals = None
+        self.count = 0
+
+    def _ensure_capacity(self, capacity):
+        if capacity <= len(self.points):
+            return
+
+        new_capacity = max(capacity, 2 * len(self.points))
+
+        points = np.empty((new_capacity, 3), dtype=np.float32)
+        points[:self.count] = self.points[:self.count]
+        self.points = points
+
+        colors = np.empty((new_capacity, 3), dtype=np.float32)
+        colors[:self.count] = self.colors[:self.count]
+        self.colors = colors
+
+        normals = np.empty((new_capacity, 3), dtype=np.float32)
+        normals[:self.count] = self.normals[:self.count]
+        self.normals = normals
+
+    def add(self, points, colors, normals = None):
+        """Adds the points (and their colors and normals) that fall within voxels not
+        already occupied by a previously added point. The normals are only kept if they
+        are given for all the added points."""
+
+        if normals is not None and len(normals) == 0:
+            normals = None
+
+        self.has_normals = (normals is not None) if self.has_normals is None else (self.has_normals and normals is not None)
+
+        new = _add_new_voxels(self.voxel_index, np.ascontiguousarray(points), self.voxel_size, self.count)
+
+        if len(new) == 0:
+            return
+
+        end = self.count + len(new)
+        self._ensure_capacity(end)
+
+        self.points[self.count:end] = points[new]
+        self.colors[self.count:end] = colors[new]
+        if self.has_normals:
+            self.normals[self.count:end] = normals[new]
+
+        self.count = end
+
+    def to_point_cloud(self):
+        """Returns an Open3D point cloud containing one point per occupied voxel."""
+
+        cloud = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(self.points[:self.count]))
+        cloud.colors = o3d.utility.Vector3dVector(self.colors[:self.count])
+
+        if self.has_normals:
+            cloud.normals = o3d.utility.Vector3dVector(self.normals[:self.count])
+
+        return cloud